@@ -1,8 +1,11 @@
+import io
 import json
+import textwrap
 from pathlib import Path
 
 import pandas as pd
 import streamlit as st
+from sql_8week_danny.result_store import ResultEntry, ResultStore
 from sql_8week_danny.sql_engine import DuckDBEngine
 
 import tomllib
@@ -42,20 +45,68 @@ def handle_query(db, query):
         return f"ERROR: {validate[1]}"
 
 
-def add_response_to_chat_hist(response):
-    # if isinstance(response, pd.DataFrame):
-    #    # Convert DataFrame to a list of records for JSON serialization
-    #    serial_response = response.to_dict('records')
-    # else:
-    serial_response = response
-    st.session_state.chat_hist.append({config["app"]["response_name"]: serial_response})
+def setup_result_store(config):
+    history = config["history"]
+    return ResultStore(
+        spill_dir=Path.cwd() / history["spill_dir"],
+        session_budget_mb=history["session_budget_mb"],
+        global_budget_mb=history["global_budget_mb"],
+        preview_rows=history["preview_rows"],
+        compression=history["compression"],
+    )
+
+
+def add_response_to_chat_hist(query, response):
+    # DataFrames are stored compressed in the session's ResultStore;
+    # the chat history only keeps the (small) ResultEntry handle.
+    # Store first so a failure can't leave a prompt without a response.
+    if isinstance(response, pd.DataFrame):
+        response = st.session_state.result_store.put(response)
+    st.session_state.chat_hist.append({config["app"]["prompt_name"]: query})
+    st.session_state.chat_hist.append({config["app"]["response_name"]: response})
+
+
+def result_caption(entry):
+    caption = f"{entry.num_rows} rows x {entry.num_columns} columns"
+    if entry.full_available:
+        caption += f" ({entry.nbytes / 1024:.1f} KB compressed)"
+    if entry.stringified:
+        caption += " - values stored as text"
+    if entry.truncated:
+        caption += f" - full result unavailable, first {len(entry.preview)} rows only"
+    return caption
+
+
+def show_result(entry):
+    store = st.session_state.result_store
+    if entry.num_rows <= len(entry.preview) or not entry.full_available:
+        st.caption(result_caption(entry))
+        st.dataframe(entry.preview)
+    # Full result is only rehydrated (possibly from disk) when asked for
+    elif st.toggle(f"Show all {entry.num_rows} rows", key=f"full_{entry.key}"):
+        df = store.get(entry, cache=True)
+        st.caption(result_caption(entry))
+        st.dataframe(df)
+    else:
+        st.caption(result_caption(entry))
+        st.dataframe(entry.preview)
 
 
-def convert_chat_hist_to_serial(chat_hist):
-    serial_history = []
+def iter_chat_hist_serial(chat_hist):
+    # Generator, so only one (possibly spilled) result is rehydrated at a time
     for entry in chat_hist:
         serial_entry = {}
         for key, value in entry.items():
+            if isinstance(value, ResultEntry):
+                result_entry = value
+                value = st.session_state.result_store.get(result_entry)
+                # Mark results that aren't exported in full or as stored
+                if result_entry.truncated:
+                    serial_entry["truncated"] = (
+                        f"first {len(value)} of {result_entry.num_rows} rows only"
+                    )
+                if result_entry.stringified:
+                    serial_entry["stringified"] = True
             if isinstance(value, pd.DataFrame):
                 # Convert DataFrame to a list of records (dictionaries)
                 value = value.map(
@@ -72,8 +123,21 @@ def convert_chat_hist_to_serial(chat_hist):
                     for record in value
                 ]
             serial_entry[key] = value
-        serial_history.append(serial_entry)
-    return serial_history
+        yield serial_entry
+
+
+def chat_hist_to_json(chat_hist):
+    # Same layout as json.dumps(list, indent=4), written one entry at a time
+    out = io.StringIO()
+    out.write("[")
+    n_entries = 0
+    for serial_entry in iter_chat_hist_serial(chat_hist):
+        out.write(",\n" if n_entries else "\n")
+        serial_json = json.dumps(serial_entry, indent=4, default=default_handler)
+        out.write(textwrap.indent(serial_json, "    "))
+        n_entries += 1
+    out.write("\n]" if n_entries else "]")
+    return out.getvalue()
 
 
 def get_sql_queries_only(chat_hist):
@@ -112,6 +176,9 @@ for table in db.table_names:
 if "chat_hist" not in st.session_state:
     st.session_state.chat_hist = []
 
+if "result_store" not in st.session_state:
+    st.session_state.result_store = setup_result_store(config)
+
 st.sidebar.markdown(f"## {config['app']['title']}")
 
 
@@ -128,8 +195,7 @@ if user_query:
 
     response = handle_query(db, user_query)
     if isinstance(response, pd.DataFrame):
-        st.session_state.chat_hist.append({config["app"]["prompt_name"]: user_query})
-        add_response_to_chat_hist(response)
+        add_response_to_chat_hist(user_query, response)
     else:
         error_sidebar.error(response)
 
@@ -139,7 +205,11 @@ for chat in st.session_state.chat_hist:
         st.code(f"{chat[config['app']['prompt_name']]}")
     elif config["app"]["response_name"] in chat:
         st.caption(f"{config['app']['response_name']}:")
-        st.write(chat[config["app"]["response_name"]])
+        response = chat[config["app"]["response_name"]]
+        if isinstance(response, ResultEntry):
+            show_result(response)
+        else:
+            st.write(response)
         st.markdown("----")
 
 
@@ -149,8 +219,7 @@ sql_limit = st.sidebar.number_input("Limit rows:", min_value=1, value=10, step=1
 # Download buttons
 
 if st.sidebar.button("Download Query History"):
-    serial_chat_hist = convert_chat_hist_to_serial(st.session_state.chat_hist)
-    chat_hist_json = json.dumps(serial_chat_hist, indent=4, default=default_handler)
+    chat_hist_json = chat_hist_to_json(st.session_state.chat_hist)
 
     # Create a download button for the JSON file
     st.sidebar.download_button(
@@ -0,0 +1,366 @@
+import os
+import shutil
+import threading
+import time
+import uuid
+import weakref
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from itertools import count
+from pathlib import Path
+from typing import Optional
+
+import pandas as pd
+import pyarrow as pa
+from loguru import logger
+
+MB = 1024 * 1024
+
+# Spill files in our own directory older than this were left by an earlier
+# process with the same pid (e.g. pid 1 in a restarted container)
+PROCESS_START = time.time()
+PROCESS_DIR_PREFIX = "proc-"
+
+
+@dataclass(eq=False)
+class ResultEntry:
+    key: int
+    num_rows: int
+    num_columns: int
+    nbytes: int
+    preview: pd.DataFrame
+    preview_bytes: int
+    seq: int
+    blob: Optional[bytes] = field(default=None, repr=False)
+    path: Optional[Path] = None
+    spilling: bool = False
+    stringified: bool = False
+    unavailable: bool = False
+
+    @property
+    def in_memory(self) -> bool:
+        return self.blob is not None and not self.spilling
+
+    @property
+    def full_available(self) -> bool:
+        return not self.unavailable and (self.blob is not None or self.path is not None)
+
+    @property
+    def truncated(self) -> bool:
+        return not self.full_available and self.num_rows > len(self.preview)
+
+
+def _to_arrow_blob(df: pd.DataFrame, compression: str) -> bytes:
+    table = pa.Table.from_pandas(df)
+    sink = pa.BufferOutputStream()
+    options = pa.ipc.IpcWriteOptions(compression=compression)
+    with pa.ipc.new_file(sink, table.schema, options=options) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+def _from_arrow_blob(buffer) -> pd.DataFrame:
+    return pa.ipc.open_file(buffer).read_all().to_pandas()
+
+
+def _frame_bytes(df: pd.DataFrame) -> int:
+    return int(df.memory_usage(deep=True).sum())
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+@dataclass
+class CachedFrame:
+    df: pd.DataFrame
+    nbytes: int
+    seq: int
+
+
+class ResultStore:
+    """
+    Per-session store for query results, kept as compressed Arrow IPC blobs.
+    Blobs beyond the per-session or global (all sessions) byte budget are spilled
+    to disk, oldest first, and read back only when the full result is requested.
+    Only a bounded preview DataFrame is kept in memory for each entry; previews
+    count towards the budgets but are never spilled. Rehydrated frames cached by
+    get(cache=True) also count, and are evicted before any blob is spilled.
+    """
+
+    _lock = threading.RLock()
+    _stores = weakref.WeakSet()
+    _swept_dirs = set()
+    _global_bytes = 0
+    _seq = count()
+
+    def __init__(
+        self,
+        spill_dir=".cache/results",
+        session_budget_mb=64,
+        global_budget_mb=512,
+        preview_rows=20,
+        compression="zstd",
+    ):
+        """
+        :param spill_dir: Path or str directory for spilled result blobs; each
+            process spills into its own proc-<pid> subdirectory
+        :param session_budget_mb: In-memory budget for this session (MB)
+        :param global_budget_mb: In-memory budget shared by all sessions (MB)
+        :param preview_rows: Number of rows kept in memory for inline display
+        :param compression: Arrow IPC compression codec ("zstd", "lz4" or None)
+        """
+        self.spill_root = Path(spill_dir)
+        self.spill_dir = self.spill_root / f"{PROCESS_DIR_PREFIX}{os.getpid()}"
+        self.session_budget = int(session_budget_mb * MB)
+        self.global_budget = int(global_budget_mb * MB)
+        self.preview_rows = preview_rows
+        self.compression = compression
+        self.session_id = uuid.uuid4().hex
+        self.entries = {}
+        self.memory_bytes = 0
+        self._next_key = count()
+        self._frames = OrderedDict()
+        # Mutable cell so the finalizer sees the final in-memory total
+        self._memory_cell = [0]
+        with ResultStore._lock:
+            ResultStore._stores.add(self)
+            if self.spill_dir.resolve() not in ResultStore._swept_dirs:
+                ResultStore._swept_dirs.add(self.spill_dir.resolve())
+                self._sweep_stale()
+        weakref.finalize(
+            self,
+            ResultStore._release,
+            self._memory_cell,
+            self.spill_dir,
+            self.session_id,
+        )
+
+    @staticmethod
+    def _release(memory_cell, spill_dir, session_id):
+        # Called when a session's store is garbage collected
+        with ResultStore._lock:
+            ResultStore._global_bytes -= memory_cell[0]
+        for path in spill_dir.glob(f"{session_id}-*.arrow*"):
+            path.unlink(missing_ok=True)
+
+    def _sweep_stale(self):
+        # Finalizers don't run after a crash or SIGKILL. Remove the spill
+        # directories of processes that are no longer running, and files in our
+        # own directory written before this process started.
+        for proc_dir in self.spill_root.glob(f"{PROCESS_DIR_PREFIX}*"):
+            pid = proc_dir.name.removeprefix(PROCESS_DIR_PREFIX)
+            if proc_dir == self.spill_dir or not pid.isdigit() or _pid_alive(int(pid)):
+                continue
+            shutil.rmtree(proc_dir, ignore_errors=True)
+            logger.info(f"Removed stale spill directory {proc_dir}")
+        for path in self.spill_dir.glob("*.arrow*"):
+            try:
+                if path.stat().st_mtime < PROCESS_START:
+                    path.unlink(missing_ok=True)
+                    logger.info(f"Removed stale spill file {path}")
+            except OSError as e:
+                logger.warning(f"Could not remove stale spill file {path}: {e}")
+
+    def _set_memory_bytes(self, delta):
+        self.memory_bytes += delta
+        self._memory_cell[0] = self.memory_bytes
+        ResultStore._global_bytes += delta
+
+    def put(self, df: pd.DataFrame) -> ResultEntry:
+        """
+        Compress a result DataFrame into the store and enforce the byte budgets.
+        Frames Arrow can't convert (e.g. mixed-type object columns) are stored
+        with every column cast to str; if even that fails only the preview is kept.
+        :param df: Query result
+        :return: ResultEntry handle to keep in the chat history
+        """
+        stringified = False
+        try:
+            blob = _to_arrow_blob(df, self.compression)
+        except (pa.ArrowException, TypeError, ValueError) as e:
+            logger.warning(f"Result not convertible to Arrow, storing as str: {e}")
+            stringified = True
+            try:
+                blob = _to_arrow_blob(df.astype(str), self.compression)
+            except (pa.ArrowException, TypeError, ValueError) as e:
+                logger.warning(f"Result not convertible to Arrow, preview only: {e}")
+                blob = None
+        preview = df.head(self.preview_rows).copy()
+        with ResultStore._lock:
+            entry = ResultEntry(
+                key=next(self._next_key),
+                num_rows=len(df),
+                num_columns=len(df.columns),
+                nbytes=len(blob) if blob is not None else 0,
+                preview=preview,
+                preview_bytes=_frame_bytes(preview),
+                seq=next(ResultStore._seq),
+                blob=blob,
+                stringified=stringified,
+            )
+            self.entries[entry.key] = entry
+            self._set_memory_bytes(entry.nbytes + entry.preview_bytes)
+            logger.info(
+                f"Stored result {self.session_id}/{entry.key}: "
+                f"{entry.num_rows} rows, {entry.nbytes} bytes"
+            )
+            victims = self._select_victims()
+        self._spill_victims(victims)
+        return entry
+
+    def get(self, entry: ResultEntry, cache=False) -> pd.DataFrame:
+        """
+        Rehydrate the full result for an entry, from memory or the spill directory.
+        If the full result can't be read (no blob, or a missing or corrupt spill
+        file) the preview is returned and entry.full_available is False.
+        :param entry: ResultEntry returned by put()
+        :param cache: Keep the rehydrated frame in a per-session LRU cache for
+            repeated display; cached frames count towards the budgets
+        :return: Full result (or preview) as a pandas DataFrame
+        """
+        with ResultStore._lock:
+            cached = self._frames.get(entry.key)
+            if cached is not None:
+                cached.seq = next(ResultStore._seq)
+                self._frames.move_to_end(entry.key)
+                return cached.df
+            blob, path = entry.blob, entry.path
+        if not entry.full_available:
+            return entry.preview
+        try:
+            if blob is None:
+                logger.info(
+                    f"Rehydrating result {self.session_id}/{entry.key} from {path}"
+                )
+                blob = path.read_bytes()
+            df = _from_arrow_blob(pa.py_buffer(blob))
+        except (OSError, pa.ArrowException) as e:
+            logger.warning(
+                f"Result {self.session_id}/{entry.key} unavailable, using preview: {e}"
+            )
+            entry.unavailable = True
+            return entry.preview
+        if cache:
+            self._cache_frame(entry.key, df)
+        return df
+
+    def _cache_frame(self, key, df):
+        # Size is measured once, outside the lock, and kept with the frame
+        nbytes = _frame_bytes(df)
+        if nbytes > self.session_budget:
+            return
+        with ResultStore._lock:
+            if key in self._frames:
+                return
+            self._frames[key] = CachedFrame(df, nbytes, next(ResultStore._seq))
+            self._set_memory_bytes(nbytes)
+            victims = self._select_victims(keep_frame=(self, key))
+        self._spill_victims(victims)
+
+    def _evict_frame(self, key):
+        # Called under the lock
+        cached = self._frames.pop(key)
+        self._set_memory_bytes(-cached.nbytes)
+
+    def _oldest_frame(self, keep_frame):
+        for key, cached in self._frames.items():
+            if (self, key) != keep_frame:
+                return key, cached
+        return None
+
+    def _detach(self, entry: ResultEntry):
+        # Called under the lock: take the blob off the budget so it isn't chosen
+        # again, but keep it readable until the spill file is in place
+        entry.spilling = True
+        self._set_memory_bytes(-entry.nbytes)
+
+    def _spill(self, entry: ResultEntry):
+        path = self.spill_dir / f"{self.session_id}-{entry.key}.arrow"
+        tmp_path = path.with_suffix(".arrow.tmp")
+        try:
+            self.spill_dir.mkdir(parents=True, exist_ok=True)
+            tmp_path.write_bytes(entry.blob)
+            tmp_path.replace(path)
+        except OSError as e:
+            logger.error(f"Failed to spill result {self.session_id}/{entry.key}: {e}")
+            tmp_path.unlink(missing_ok=True)
+            with ResultStore._lock:
+                entry.spilling = False
+                self._set_memory_bytes(entry.nbytes)
+            return
+        with ResultStore._lock:
+            entry.path = path
+            entry.blob = None
+            entry.spilling = False
+        logger.info(f"Spilled result {self.session_id}/{entry.key} to {path}")
+
+    @staticmethod
+    def _spill_victims(victims):
+        # Disk writes happen outside the process-wide lock
+        for store, victim in victims:
+            store._spill(victim)
+
+    def _oldest_in_memory(self):
+        in_memory = [entry for entry in self.entries.values() if entry.in_memory]
+        return min(in_memory, key=lambda entry: entry.seq, default=None)
+
+    def _select_victims(self, keep_frame=None):
+        # Called under the lock. Cached frames are dropped first (keeping
+        # keep_frame, the one just cached), then blobs are detached for spilling,
+        # keeping the newest result in memory even if it alone exceeds the budget.
+        # keep_frame itself goes last.
+        victims = []
+        newest_seq = self._newest_seq()
+
+        def next_blob(stores):
+            candidates = [
+                (entry, store)
+                for store in stores
+                for entry in [store._oldest_in_memory()]
+                if entry is not None and entry.seq != newest_seq
+            ]
+            return min(candidates, key=lambda c: c[0].seq, default=None)
+
+        def next_frame(stores):
+            candidates = [
+                (found[1].seq, found[0], store)
+                for store in stores
+                for found in [store._oldest_frame(keep_frame)]
+                if found is not None
+            ]
+            return min(candidates, key=lambda c: c[0], default=None)
+
+        def shrink(over_budget, stores):
+            while over_budget():
+                frame = next_frame(stores)
+                if frame is not None:
+                    _, key, store = frame
+                    store._evict_frame(key)
+                    continue
+                blob = next_blob(stores)
+                if blob is not None:
+                    entry, store = blob
+                    store._detach(entry)
+                    victims.append((store, entry))
+                    continue
+                if keep_frame is not None and keep_frame[1] in keep_frame[0]._frames:
+                    keep_frame[0]._evict_frame(keep_frame[1])
+                    continue
+                break
+
+        shrink(lambda: self.memory_bytes > self.session_budget, [self])
+        shrink(
+            lambda: ResultStore._global_bytes > self.global_budget,
+            list(ResultStore._stores),
+        )
+        return victims
+
+    def _newest_seq(self):
+        return max((entry.seq for entry in self.entries.values()), default=None)
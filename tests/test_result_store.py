@@ -0,0 +1,175 @@
+import gc
+import os
+import subprocess
+import sys
+
+import pandas as pd
+import pytest
+
+from sql_8week_danny.result_store import MB, PROCESS_START, ResultStore
+
+
+def make_df(n_rows=20000, seed=0):
+    return pd.DataFrame(
+        {
+            "x": [(i * 7919 + seed) % 100003 / 7.0 for i in range(n_rows)],
+            "t": pd.date_range("2020-01-01", periods=n_rows, freq="s"),
+            "s": [f"row-{seed}-{i}" for i in range(n_rows)],
+        }
+    )
+
+
+@pytest.fixture(autouse=True)
+def collect_stores():
+    # Drop stores left over from other tests so global accounting starts clean
+    gc.collect()
+    yield
+    gc.collect()
+
+
+def test_round_trip_memory(tmp_path):
+    store = ResultStore(tmp_path)
+    df = make_df()
+    entry = store.put(df)
+    assert entry.in_memory
+    assert entry.num_rows == len(df)
+    assert len(entry.preview) == store.preview_rows
+    pd.testing.assert_frame_equal(store.get(entry), df)
+
+
+def test_round_trip_disk(tmp_path):
+    store = ResultStore(tmp_path, session_budget_mb=0)
+    dfs = [make_df(seed=0), make_df(seed=1)]
+    entries = [store.put(df) for df in dfs]
+    assert not entries[0].in_memory
+    assert entries[0].path.exists()
+    for entry, df in zip(entries, dfs):
+        pd.testing.assert_frame_equal(store.get(entry), df)
+
+
+def test_session_budget_spills_oldest_keeps_newest(tmp_path):
+    df = make_df()
+    probe = ResultStore(tmp_path)
+    probe_entry = probe.put(df)
+    entry_bytes = probe_entry.nbytes + probe_entry.preview_bytes
+    del probe
+    gc.collect()
+
+    # Room for two entries (blobs plus previews), not three
+    store = ResultStore(tmp_path, session_budget_mb=2.5 * entry_bytes / MB)
+    entries = [store.put(make_df(seed=seed)) for seed in range(3)]
+    assert [entry.in_memory for entry in entries] == [False, True, True]
+    assert store.memory_bytes <= store.session_budget
+
+    # The newest entry stays in memory even when it alone exceeds the budget
+    tiny = ResultStore(tmp_path, session_budget_mb=0)
+    newest = tiny.put(df)
+    assert newest.in_memory
+
+
+def test_global_budget_spills_other_store(tmp_path):
+    df = make_df()
+    baseline = ResultStore._global_bytes
+    first = ResultStore(tmp_path)
+    old = first.put(df)
+    used = ResultStore._global_bytes - baseline
+
+    second = ResultStore(tmp_path, global_budget_mb=(baseline + 1.5 * used) / MB)
+    new = second.put(make_df(seed=1))
+    assert not old.in_memory
+    assert old.path.exists()
+    assert new.in_memory
+    pd.testing.assert_frame_equal(first.get(old), df)
+
+
+def test_release_on_garbage_collection(tmp_path):
+    baseline = ResultStore._global_bytes
+    store = ResultStore(tmp_path, session_budget_mb=0)
+    for seed in range(3):
+        store.put(make_df(seed=seed))
+    assert list(tmp_path.rglob("*.arrow"))
+    assert ResultStore._global_bytes > baseline
+
+    del store
+    gc.collect()
+    assert ResultStore._global_bytes == baseline
+    assert not list(tmp_path.rglob("*.arrow*"))
+
+
+def test_unconvertible_frame_falls_back_to_str(tmp_path):
+    store = ResultStore(tmp_path)
+    df = pd.DataFrame({"m": [{1: 2}, {1: 2}, {1: 2}], "mixed": [1, "a", 2.5]})
+    entry = store.put(df)
+    assert entry.stringified
+    result = store.get(entry)
+    assert len(result) == 3
+    assert result["m"].tolist() == ["{1: 2}"] * 3
+    assert result["mixed"].tolist() == ["1", "a", "2.5"]
+    pd.testing.assert_frame_equal(entry.preview, df)
+
+
+def test_preview_only_entry_is_flagged(tmp_path, monkeypatch):
+    store = ResultStore(tmp_path, preview_rows=5)
+
+    def fail(*args):
+        raise TypeError("unconvertible")
+
+    monkeypatch.setattr("sql_8week_danny.result_store._to_arrow_blob", fail)
+    df = make_df(n_rows=50)
+    entry = store.put(df)
+    assert not entry.full_available
+    assert entry.truncated
+    pd.testing.assert_frame_equal(store.get(entry), df.head(5))
+
+
+def test_missing_spill_file_returns_preview(tmp_path):
+    store = ResultStore(tmp_path, session_budget_mb=0)
+    entries = [store.put(make_df(seed=seed)) for seed in range(2)]
+    spilled = entries[0]
+    spilled.path.unlink()
+    result = store.get(spilled, cache=True)
+    pd.testing.assert_frame_equal(result, spilled.preview)
+    assert spilled.truncated
+
+
+def test_get_cache_reuses_rehydrated_frame(tmp_path):
+    store = ResultStore(tmp_path)
+    entry = store.put(make_df())
+    assert store.get(entry) is not store.get(entry)
+    assert store.get(entry, cache=True) is store.get(entry)
+
+
+def test_cached_frames_count_towards_global_budget(tmp_path):
+    baseline = ResultStore._global_bytes
+    df = make_df()
+    frame_bytes = int(df.memory_usage(deep=True).sum())
+    stores = [
+        ResultStore(tmp_path, global_budget_mb=(baseline + 2.5 * frame_bytes) / MB)
+        for _ in range(4)
+    ]
+    for store in stores:
+        store.get(store.put(df), cache=True)
+
+    assert ResultStore._global_bytes - baseline <= 2.5 * frame_bytes
+    assert sum(len(store._frames) for store in stores) <= 2
+    # The most recently cached frame is kept; older ones go before any blob
+    assert len(stores[-1]._frames) == 1
+    assert all(entry.in_memory for store in stores for entry in store.entries.values())
+
+
+def test_stale_spill_dirs_swept(tmp_path):
+    finished = subprocess.Popen([sys.executable, "-c", "pass"])
+    finished.wait()
+    dead_dir = tmp_path / f"proc-{finished.pid}"
+    live_dir = tmp_path / f"proc-{os.getppid()}"
+    own_dir = tmp_path / f"proc-{os.getpid()}"
+    for proc_dir in (dead_dir, live_dir, own_dir):
+        proc_dir.mkdir()
+        stale = proc_dir / "deadbeef-0.arrow"
+        stale.write_bytes(b"stale")
+        os.utime(stale, (PROCESS_START - 60, PROCESS_START - 60))
+
+    ResultStore(tmp_path)
+    assert not dead_dir.exists()
+    assert (live_dir / "deadbeef-0.arrow").exists()
+    assert not (own_dir / "deadbeef-0.arrow").exists()